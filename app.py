@@ -9,48 +9,80 @@ Token:
     https://developers.tiktok.com/doc/oauth-user-access-token-management/
 """
 
-from flask import Flask, redirect, request, session, url_for
-import hashlib, base64, os, requests, urllib.parse, random
-import json
+from flask import Flask, redirect, request, make_response
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+import hashlib, base64, os, requests, urllib.parse, secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from utils import log_error
-from config import CLIENT_KEY, CLIENT_SECRET , REDIRECT_URI, USER_TOKEN_FILENAME
+from requests.adapters import HTTPAdapter
+from utils import log_error, read_tokens, append_tokens
+from config import CLIENT_KEY, CLIENT_SECRET , REDIRECT_URI, USER_TOKEN_FILENAME, MAX_RETRIES, POOL_CONNECTIONS, POOL_MAXSIZE, REFRESH_WORKERS
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 
-def generate_code_verifier(min=43, max=128):
-    """Generate code verifier per tiktok's guidelnies"""
-    characters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~'
-    return ''.join(random.choice(characters) for _ in range(random.choice(range(min,max))))
+# PKCE verifier and CSRF state travel between /login and /callback/ in one signed cookie
+PKCE_COOKIE_NAME = 'pkce'
+PKCE_COOKIE_MAX_AGE = 600
+pkce_serializer = URLSafeTimedSerializer(app.secret_key, salt='pkce')
+
+# Shared session so token requests reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=MAX_RETRIES))
+SESSION.headers.update({
+    'Content-Type': 'application/x-www-form-urlencoded',
+    'Cache-Control': 'no-cache'
+})
+
+# Client key and redirect uri are fixed for the process, so quote them once when building the template.
+# Left as None when either setting is missing so /login can report it instead of redirecting with empty values.
+MISSING_AUTH_SETTINGS = [name for name, value in (('TIKTOK_CLIENT_ID', CLIENT_KEY), ('TIKTOK_REDIRECT_URI', REDIRECT_URI)) if not value]
+AUTHORIZATION_URL_TEMPLATE = None if MISSING_AUTH_SETTINGS else (
+    "https://www.tiktok.com/v2/auth/authorize/"
+    f"?client_key={urllib.parse.quote(CLIENT_KEY)}"
+    "&response_type=code"
+    "&scope=user.info.basic,video.publish,video.upload"
+    f"&redirect_uri={urllib.parse.quote(REDIRECT_URI)}"
+    "&state={state}"
+    "&code_challenge={code_challenge}"
+    "&code_challenge_method=S256"
+)
+
+def generate_code_verifier(nbytes=64):
+    """
+    Generate code verifier per tiktok's guidelnies (43-128 unreserved characters).
+    token_urlsafe emits ~1.3 characters per byte, so 64 bytes gives an 86 character verifier.
+    """
+    return secrets.token_urlsafe(nbytes)[:128]
 
 def generate_code_challenge(verifier):
-    """Generate code challenge from the code verifier using SHA256 and hex encoding."""
-    sha256_hash = hashlib.sha256(verifier.encode()).hexdigest() 
-    return sha256_hash
+    """
+    Generate code challenge from the code verifier using SHA256 and hex encoding.
+    TikTok's desktop login kit expects hex here, not the base64url encoding from RFC 7636.
+    """
+    return hashlib.sha256(verifier.encode('ascii')).hexdigest()
 
 # Storing data in json file locally for now.
+TOKEN_FILE_LOCK = threading.Lock()
+
+# Token updates held back by save_token_data(flush=False) until flush_token_data is called
+_pending_tokens = {}
+
 def load_tokens(filename=USER_TOKEN_FILENAME):
-    """Load tokens from the JSON file"""
-    if os.path.exists(filename):
-        with open(filename, 'r') as f:
-            return json.load(f)
-    return {}
-
-def save_tokens(data, filename=USER_TOKEN_FILENAME):
-    """Save tokens to JSON file"""
-    try:
-        with open(filename, 'w') as f:
-            json.dump(data, f, indent=4)
-    except Exception as e:
-        print(f"[Error]: {e}")
+    """Load tokens from the JSON file (cached until the file changes)"""
+    return read_tokens(filename)
 
-def save_token_data(response, open_id):
+def save_token_data(response, open_id, flush=True):
     """
     Saves token data after user authorization.
-    Adds expiration dates for access and refresh tokens based on request time.
+    Adds expiration dates for access and refresh tokens based on request time,
+    as ISO strings for reading and epoch seconds (expires_at, refresh_expires_at) for comparisons.
+    With flush=False the update is buffered until flush_token_data() writes the whole batch.
     """
     datetime_now = datetime.now()
+    timestamp_now = int(datetime_now.timestamp())
 
     expires_in = response.get('expires_in')
     refresh_expires_in = response.get('refresh_expires_in')
@@ -58,43 +90,80 @@ def save_token_data(response, open_id):
     if expires_in is not None:
         expires_in_datetime = datetime_now + timedelta(seconds=expires_in)
         response['expires_in_datetime'] = expires_in_datetime.isoformat()
+        response['expires_at'] = timestamp_now + expires_in
     else:
         print(f"[Warning]: 'expires_in' not found for user {open_id}.")
 
     if refresh_expires_in is not None:
         refresh_expires_in_datetime = datetime_now + timedelta(seconds=refresh_expires_in)
         response['refresh_expires_in_datetime'] = refresh_expires_in_datetime.isoformat()
+        response['refresh_expires_at'] = timestamp_now + refresh_expires_in
     else:
         print(f"[Warning]: 'refresh_expires_in' not found for user {open_id}.")
 
     response['open_id'] = open_id 
 
-    data = load_tokens()
-    data[open_id] = response 
-    save_tokens(data)
+    # Refreshes can run concurrently - guard the shared buffer; flush_token_data does the file write
+    with TOKEN_FILE_LOCK:
+        _pending_tokens[open_id] = response
+    if flush:
+        flush_token_data()
+
+def flush_token_data():
+    """Append all buffered token updates to the token log in a single write"""
+    with TOKEN_FILE_LOCK:
+        if not _pending_tokens:
+            return
+        try:
+            append_tokens(_pending_tokens, USER_TOKEN_FILENAME)
+        except Exception as e:
+            print(f"[Error]: {e}")
+        _pending_tokens.clear()
+
+def expiry_timestamp(token_data, key, datetime_key):
+    """Epoch seconds for an expiry, falling back to the ISO string for records saved before expires_at existed"""
+    timestamp = token_data.get(key)
+    if timestamp is None:
+        timestamp = datetime.fromisoformat(token_data[datetime_key]).timestamp()
+    return timestamp
 
 def check_and_refresh_tokens():
     """Check for expired tokens and refresh if possible"""
     data = load_tokens()
+    now = time.time()
+    to_refresh = []
     for open_id, token_data in data.items():
-        refresh_token = token_data.get('refresh_token')
-        expires_in_datetime = datetime.fromisoformat(token_data['expires_in_datetime'])
-        refresh_expires_in_datetime = datetime.fromisoformat(token_data['refresh_expires_in_datetime'])
-        
-        # Check if access token is expired
-        if datetime.now() >= expires_in_datetime:
-            # Check if refresh token is still valid 
-            if datetime.now() < refresh_expires_in_datetime:
-                new_token_response = refresh_access_token(refresh_token, open_id)
+        # Skip users whose access token is still valid
+        if now < expiry_timestamp(token_data, 'expires_at', 'expires_in_datetime'):
+            continue
+
+        # Check if refresh token is still valid 
+        if now < expiry_timestamp(token_data, 'refresh_expires_at', 'refresh_expires_in_datetime'):
+            to_refresh.append((token_data.get('refresh_token'), open_id))
+        else:
+            print(f"Refresh token expired for user {open_id}. Re-authentication required.")
+
+    # Refresh requests are network bound, so send them concurrently
+    try:
+        with ThreadPoolExecutor(max_workers=REFRESH_WORKERS) as executor:
+            futures = {executor.submit(refresh_access_token, refresh_token, open_id, flush=False): open_id for refresh_token, open_id in to_refresh}
+            for future in as_completed(futures):
+                open_id = futures[future]
+                try:
+                    new_token_response = future.result()
+                except Exception as e:
+                    log_error(f"Error refreshing token for user {open_id}: {e}")
+                    new_token_response = None
                 if new_token_response:
                     print(f"Token refreshed successfully for user {open_id}")
                 else:
                     print(f"Failed to refresh token for user {open_id}")
-            else:
-                print(f"Refresh token expired for user {open_id}. Re-authentication required.")
+    finally:
+        # Write every refreshed token in one pass instead of once per user - even if the batch was interrupted
+        flush_token_data()
 
 # Refreshing tokens is a simple post request since it does not require redirect
-def refresh_access_token(refresh_token, open_id):
+def refresh_access_token(refresh_token, open_id, flush=True):
     """Function to refresh access token using refresh token (without needing user to auth again)."""
     token_url = "https://open.tiktokapis.com/v2/oauth/token/"
     token_data = {
@@ -104,12 +173,7 @@ def refresh_access_token(refresh_token, open_id):
         'refresh_token': refresh_token
     }
 
-    token_headers = {
-        'Content-Type': 'application/x-www-form-urlencoded',
-        'Cache-Control': 'no-cache'
-    }
-
-    response = requests.post(token_url, data=token_data, headers=token_headers)
+    response = SESSION.post(token_url, data=token_data)
     
     if response.status_code == 200:
         token_response = response.json()
@@ -118,7 +182,7 @@ def refresh_access_token(refresh_token, open_id):
             log_error(f"Error for user: {open_id} , Response: {token_response['error_description']}")
             return None
 
-        save_token_data(token_response, open_id)
+        save_token_data(token_response, open_id, flush=flush)
         return token_response
     else:
         log_error(f"Failed to refresh access token for user {open_id} , Response: {response.text}")
@@ -134,29 +198,26 @@ def home():
 
 @app.route('/login')
 def login():
+    if AUTHORIZATION_URL_TEMPLATE is None:
+        return f"Missing environment variable(s): {', '.join(MISSING_AUTH_SETTINGS)}", 500
+
     # Create code challenge per TikTok guideline
     code_verifier = generate_code_verifier()
     code_challenge = generate_code_challenge(code_verifier)
-
-
-    session['code_verifier'] = code_verifier
     csrf_state = base64.urlsafe_b64encode(os.urandom(16)).decode('utf-8').rstrip('=')
-    session['csrf_state'] = csrf_state
-
-    session.modified = True  
-
-    authorization_url = (
-        "https://www.tiktok.com/v2/auth/authorize/"
-        f"?client_key={urllib.parse.quote(CLIENT_KEY)}"
-        f"&response_type=code"
-        f"&scope=user.info.basic,video.publish,video.upload"
-        f"&redirect_uri={urllib.parse.quote(REDIRECT_URI)}"
-        f"&state={csrf_state}"
-        f"&code_challenge={code_challenge}"
-        f"&code_challenge_method=S256"
-    )
+
+    authorization_url = AUTHORIZATION_URL_TEMPLATE.format(state=csrf_state, code_challenge=code_challenge)
     
-    return redirect(authorization_url)
+    resp = redirect(authorization_url)
+    resp.set_cookie(
+        PKCE_COOKIE_NAME,
+        pkce_serializer.dumps({'v': code_verifier, 's': csrf_state}),
+        max_age=PKCE_COOKIE_MAX_AGE,
+        httponly=True,
+        secure=request.is_secure,
+        samesite='Lax'
+    )
+    return resp
 
 @app.route('/callback/')
 def callback():
@@ -164,12 +225,16 @@ def callback():
     code = request.args.get('code')
     state = request.args.get('state')
 
-    # Verify state from request 
-    if state != session.pop('csrf_state', None):
+    # Verify state from request against the signed cookie set by /login
+    try:
+        pkce = pkce_serializer.loads(request.cookies.get(PKCE_COOKIE_NAME, ''), max_age=PKCE_COOKIE_MAX_AGE)
+    except BadSignature:
+        pkce = {}
+    if state is None or state != pkce.get('s'):
         return "State mismatch. Potential CSRF attack.", 400
 
-    # Retrieve verifier from the session
-    code_verifier = session.get('code_verifier', None)
+    # Retrieve verifier from the cookie
+    code_verifier = pkce.get('v')
 
     # Exchange auth code for an access token with tiktok
     token_url = "https://open.tiktokapis.com/v2/oauth/token/"
@@ -182,21 +247,20 @@ def callback():
         'code_verifier': code_verifier
     }
 
-    token_headers = {
-        'Content-Type': 'application/x-www-form-urlencoded',
-        'Cache-Control': 'no-cache'
-    }
-
-    response = requests.post(token_url, data=token_data, headers=token_headers)
+    response = SESSION.post(token_url, data=token_data)
     
     if response.status_code == 200:
         token_response = response.json()
         open_id = token_response.get('open_id')
         save_token_data(token_response, open_id)
         # return f"Access token: {token_response.get('access_token')}<br>Refresh token: {token_response.get('refresh_token')}"
-        return f"Retrieved Scoped Access Token Successfully."
+        resp = make_response("Retrieved Scoped Access Token Successfully.")
     else:
-        return f"Failed to obtain access token: {response.text}", 400
+        resp = make_response(f"Failed to obtain access token: {response.text}", 400)
+
+    # The verifier and state are single use
+    resp.delete_cookie(PKCE_COOKIE_NAME)
+    return resp
     
 @app.route('/refresh_token/')
 def refresh_token_route():
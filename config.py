@@ -5,8 +5,29 @@ CLIENT_KEY = os.getenv('TIKTOK_CLIENT_ID')
 CLIENT_SECRET = os.getenv('TIKTOK_CLIENT_SECRET')
 REDIRECT_URI = os.getenv('TIKTOK_REDIRECT_URI')
 
+# Print per-chunk upload responses
+DEBUG = os.getenv('TIKTOK_UPLOADER_DEBUG', '').lower() in ('1', 'true', 'yes')
+
 # Retry settings
 MAX_RETRIES = 2
 
+# Backoff between retries: RETRY_BASE_DELAY * 2^attempt seconds plus jitter, capped at RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 0.2
+RETRY_MAX_DELAY = 5.0
+
+# Upper bound on a server-requested Retry-After wait, so one entry can't stall the whole batch
+RETRY_AFTER_MAX_DELAY = 60
+
+# HTTP connection pool settings (keep-alive connections reused across API calls)
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 20
+
+# Number of chunk PUTs in flight at once. TikTok's media transfer guide expects chunks
+# in order, so keep this at 1 unless the upload endpoint accepts out-of-order ranges.
+UPLOAD_WORKERS = int(os.getenv('TIKTOK_UPLOAD_WORKERS', 1))
+
+# Number of token refresh requests sent concurrently
+REFRESH_WORKERS = 8
+
 # Local token file used as storage - replace with database when needed
 USER_TOKEN_FILENAME='user_tokens.json'
\ No newline at end of file
@@ -11,15 +11,66 @@ https://developers.tiktok.com/doc/content-posting-api-reference-direct-post/
 https://developers.tiktok.com/doc/content-posting-api-media-transfer-guide
 """
 
-import json
+import mmap
 import os
+import stat
+import threading
 import requests
-import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from utils import retry_on_failure, log_error, read_json, get_access_token_from_file
-from config import USER_TOKEN_FILENAME
+from config import USER_TOKEN_FILENAME, MAX_RETRIES, POOL_CONNECTIONS, POOL_MAXSIZE, UPLOAD_WORKERS, DEBUG
+
+# Shared session so every API call and chunk PUT reuses pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=MAX_RETRIES))
+
+# httpx (with h2) is optional - when installed, chunk PUTs are multiplexed as HTTP/2 streams over one connection.
+# Without it they go through SESSION over HTTP/1.1.
+try:
+    import httpx
+    UPLOAD_CLIENT = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=POOL_CONNECTIONS, max_keepalive_connections=POOL_CONNECTIONS),
+        timeout=60.0
+    )
+except ImportError:
+    UPLOAD_CLIENT = None
+
+def create_auth_session(access_token):
+    """
+    Session carrying the user's auth headers for API calls.
+    Mounts the shared adapter so it draws from the same connection pool as SESSION.
+    """
+    auth_session = requests.Session()
+    auth_session.mount('https://', SESSION.get_adapter('https://'))
+    auth_session.headers.update({
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json; charset=UTF-8",
+        "Cache-Control": "no-cache"
+    })
+    return auth_session
+
+# Per the media transfer guidelines, chunks are at most 64MB and the leftover bytes are merged into the last chunk
+MAX_CHUNK_SIZE = 64_000_000
+
+def plan_chunks(video_size, chunk_size):
+    """
+    Returns the (start_byte, end_byte) range of every chunk, inclusive.
+    There are video_size // chunk_size chunks (at least one); the last one runs to the end of the file.
+    """
+    total_chunk_count = max(1, video_size // chunk_size)
+    plan = [(index * chunk_size, (index + 1) * chunk_size - 1) for index in range(total_chunk_count - 1)]
+    plan.append(((total_chunk_count - 1) * chunk_size, video_size - 1))
+    return plan
+
+def raise_if_retryable(response):
+    """Raise for rate limiting (429) and server errors so retry_on_failure backs off and honours Retry-After"""
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
 
 # Invoke post endpoint to get an upload URL 
-def initialize_video_upload(access_token, video_size, title, **kwargs):
+def initialize_video_upload(auth_session, video_size, chunk_size, total_chunk_count, title, **kwargs):
     """
     Function to initialize video upload with tiktok server.
     """
@@ -33,13 +84,6 @@ def initialize_video_upload(access_token, video_size, title, **kwargs):
     is_aigc = kwargs.get('is_aigc', False)
 
     url = "https://open.tiktokapis.com/v2/post/publish/video/init/"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json; charset=UTF-8"
-    }
-
-    chunk_size = min(64_000_000, video_size)
-    total_chunk_count = (video_size // chunk_size) + (1 if video_size % chunk_size > 0 else 0)-1
 
     # Post upload required fields
     post_info = {
@@ -70,68 +114,97 @@ def initialize_video_upload(access_token, video_size, title, **kwargs):
         "source_info": source_info
     }
 
-    response = requests.post(url, headers=headers, json=data)
+    response = auth_session.post(url, json=data)
     if response.status_code == 200:
-        return response.json()['data'] , source_info
+        return response.json()['data']
     else:
         log_error(f"Error initializing video upload: {response.status_code} - {response.text}")
+        raise_if_retryable(response)
         return None
 
-# Splits video file into chunks and prepare it for upload.
-# per the media transfer guidelines, the last chunk needs to be merged if it is atleast 5MB and less than 64MB
-def upload_video_to_tiktok(upload_url, video_path, chunk_size):
-    if os.path.exists(video_path) and os.path.isfile(video_path):
-        video_size = os.path.getsize(video_path)
-
-        # Calculate total chunks, leaving the last chunk to include the leftover bytes
-        total_chunk_count = (video_size // chunk_size) + (1 if video_size % chunk_size > 0 else 0) - 1
-
-        with open(video_path, 'rb') as video_file:
-            for chunk_index in range(total_chunk_count):
-
-                start_byte = chunk_index * chunk_size
-                end_byte = min(start_byte + chunk_size, video_size) - 1
-
-                remaining_bytes = video_size - end_byte 
-
-                if remaining_bytes < chunk_size:
-                    end_byte = video_size - 1
-
-                print(f"chunk_index: {chunk_index} , start_byte: {start_byte}, end_byte: {end_byte}")
-                
-                video_file.seek(start_byte)
-                chunk_data = video_file.read(end_byte - start_byte + 1)
-
-                headers = {
-                    "Content-Type": "video/mp4",
-                    "Content-Length": str(len(chunk_data)),
-                    "Content-Range": f"bytes {start_byte}-{end_byte}/{video_size}"
-                }
-
-                response = requests.put(upload_url, headers=headers, data=chunk_data)
-
-                print(f"response.status_code: {response.status_code} - {response.text}")
-    else:
-        log_error(f"Invalid file: {video_path}")
+# Headers shared by every chunk PUT; per-chunk fields are added on top
+CHUNK_BASE_HEADERS = {"Content-Type": "video/mp4"}
+
+# Each upload worker reuses one headers dict, updating only the per-chunk fields.
+# Thread-local because workers run concurrently; requests and httpx copy the headers they are given.
+_chunk_headers = threading.local()
+
+# Uploads a single byte range of the memory-mapped video. The read-only view is safe to share between workers.
+def upload_chunk(upload_url, video_view, start_byte, end_byte, video_size):
+    headers = getattr(_chunk_headers, 'headers', None)
+    if headers is None:
+        headers = _chunk_headers.headers = dict(CHUNK_BASE_HEADERS)
+    headers["Content-Length"] = str(end_byte - start_byte + 1)
+    headers["Content-Range"] = f"bytes {start_byte}-{end_byte}/{video_size}"
+
+    # Slicing the view is zero-copy - the socket reads straight from the page cache.
+    # Release the slice afterwards so the mapping can be closed once all chunks are sent.
+    with video_view[start_byte:end_byte + 1] as chunk_data:
+        if UPLOAD_CLIENT is not None:
+            # httpx would iterate a bare memoryview byte by byte, so hand it over as a single-part stream
+            response = UPLOAD_CLIENT.put(upload_url, headers=headers, content=iter((chunk_data,)))
+        else:
+            response = SESSION.put(upload_url, headers=headers, data=chunk_data)
+
+    if DEBUG:
+        print(f"start_byte: {start_byte}, end_byte: {end_byte} response.status_code: {response.status_code} - {response.text}")
+    response.raise_for_status()
+    return response.status_code
+
+# Uploads the video chunks laid out by plan_chunks
+def upload_video_to_tiktok(upload_url, video_path, plan, video_size):
+    with open(video_path, 'rb') as video_file:
+        video_map = mmap.mmap(video_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        with memoryview(video_map) as video_view:
+            # Upload byte ranges concurrently on the pooled session, failing fast on the first bad response
+            with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+                submit = executor.submit
+                futures = [
+                    submit(upload_chunk, upload_url, video_view, start_byte, end_byte, video_size)
+                    for start_byte, end_byte in plan
+                ]
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception:
+                        for pending in futures:
+                            pending.cancel()
+                        raise
+    finally:
+        try:
+            video_map.close()
+        except BufferError:
+            pass  # a failed request's traceback still references a chunk view; the map is freed with it
 
 # Get creator profile setting info - posting api requires upload metadata to match users profile setting
-def query_creator_info(access_token):
+def query_creator_info(auth_session):
     url = "https://open.tiktokapis.com/v2/post/publish/creator_info/query/"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json; charset=UTF-8"
-    }
-    response = requests.post(url, headers=headers)
+    response = auth_session.post(url)
     if response.status_code == 200:
         return response.json()['data']
     else:
         log_error(f"Error querying creator info: {response.status_code} - {response.text}")
+        raise_if_retryable(response)
         return None
 
 @retry_on_failure
 def upload_video(video_path, description, user_id, access_token):
+    # Single stat call covers the existence, regular file and size checks
+    try:
+        st = os.stat(video_path)
+    except OSError:
+        log_error(f"Invalid file: {video_path}")
+        return
+    if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+        log_error(f"Invalid file: {video_path}")
+        return
+    video_size = st.st_size
+
+    auth_session = create_auth_session(access_token)
+
     # Get user's profile setting
-    creator_info = query_creator_info(access_token)
+    creator_info = query_creator_info(auth_session)
 
     # if user info is not retrieved from info api for any reason, posting will fail. check if token expired first
     if creator_info is None: 
@@ -140,13 +213,17 @@ def upload_video(video_path, description, user_id, access_token):
 
     creator_info['privacy_level_options'] = creator_info.get('privacy_level_options', 'SELF_ONLY')[-1] # get last option or use highest privacy level
     override_params = {k: v for k, v in creator_info.items() if v is not None} # use defaults if key is missing 
-    
-    video_size = os.path.getsize(video_path)
-    
+
+    # Lay out the chunks once so the init request and the upload agree on them
+    chunk_size = min(MAX_CHUNK_SIZE, video_size)
+    plan = plan_chunks(video_size, chunk_size)
+
     # Init upload request and get upload URL 
-    init_data, s_info = initialize_video_upload(
-        access_token=access_token,
+    init_data = initialize_video_upload(
+        auth_session=auth_session,
         video_size=video_size,
+        chunk_size=chunk_size,
+        total_chunk_count=len(plan),
         title=description,
         **override_params
     )
@@ -154,8 +231,7 @@ def upload_video(video_path, description, user_id, access_token):
     # Split video file into appropriate chunks and upload
     if init_data:
         upload_url = init_data['upload_url']
-        chunk_size = s_info['chunk_size']  
-        upload_video_to_tiktok(upload_url, video_path, chunk_size)
+        upload_video_to_tiktok(upload_url, video_path, plan, video_size)
 
 def upload_all(videos):
     for entry in videos:
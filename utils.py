@@ -2,10 +2,30 @@
 
 import logging
 import os
-import traceback
-from config import MAX_RETRIES
+import random
+import time
+from config import MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_AFTER_MAX_DELAY
 import sys
-import json
+
+# orjson is optional - fall back to the stdlib json module when it is not installed
+try:
+    import orjson
+
+    def json_loads(raw):
+        return orjson.loads(raw)
+
+    def json_dumps(data, indent=True):
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else None)
+except ImportError:
+    import json
+
+    def json_loads(raw):
+        return json.loads(raw)
+
+    def json_dumps(data, indent=True):
+        if indent:
+            return json.dumps(data, indent=2).encode('utf-8')
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
 
 # Configure logging
 logging.basicConfig(
@@ -16,11 +36,33 @@ logging.basicConfig(
 
 def log_error(message):
     exc_type, exc_value, exc_traceback = sys.exc_info()
+    # Called outside an except block - there is no traceback to point at
+    if exc_traceback is None:
+        logging.error(message)
+        return
     filename = os.path.basename(exc_traceback.tb_frame.f_code.co_filename)
     lineno = exc_traceback.tb_lineno
     logging.error(f"{message} (Error in {filename} at line {lineno})")
 
 
+def retry_delay(attempt, error):
+    """
+    Seconds to wait before the next attempt: the server's Retry-After (capped at RETRY_AFTER_MAX_DELAY)
+    when the error carries one, otherwise exponential backoff with jitter capped at RETRY_MAX_DELAY.
+    """
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(int(retry_after), RETRY_AFTER_MAX_DELAY)
+    delay = RETRY_BASE_DELAY * (2 ** attempt) + random.uniform(0, RETRY_BASE_DELAY / 2)
+    return min(delay, RETRY_MAX_DELAY)
+
+def is_retryable(error):
+    """Client errors (4xx other than 429 Too Many Requests) fail the same way every time, so don't retry them"""
+    response = getattr(error, 'response', None)
+    status_code = getattr(response, 'status_code', None)
+    return status_code is None or status_code == 429 or not 400 <= status_code < 500
+
 def retry_on_failure(function):
     def wrapper(*args, **kwargs):
         for attempt in range(MAX_RETRIES):
@@ -28,17 +70,101 @@ def retry_on_failure(function):
                 return function(*args, **kwargs)
             except Exception as e:
                 log_error(f'Attempt {attempt + 1} failed: {e}')
+                import traceback  # only needed on the failure path
                 traceback.print_exc()  
+                if not is_retryable(e):
+                    raise
+                if attempt + 1 < MAX_RETRIES:
+                    time.sleep(retry_delay(attempt, e))
         raise Exception('Max retries reached')
     return wrapper
 
 
 def read_json(file_path):
-    with open(file_path, 'r') as f:
-        return json.load(f)
+    with open(file_path, 'rb') as f:
+        return json_loads(f.read())
+
+# Token storage is a JSON snapshot plus an append-only log of per-user updates next to it
+# (user_tokens.json + user_tokens.log). Reads replay the log over the snapshot, last write wins,
+# and the log is folded back into the snapshot once it grows past TOKEN_LOG_COMPACT_RATIO x the snapshot.
+TOKEN_LOG_COMPACT_RATIO = 2
+
+# In-memory copy of the token data, reused until either file changes on disk
+_TOKEN_CACHE = {'filename': None, 'state': None, 'data': None}
+
+def token_log_path(filename):
+    return os.path.splitext(filename)[0] + '.log'
+
+def _file_state(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def _token_state(filename):
+    return _file_state(filename), _file_state(token_log_path(filename))
+
+def read_tokens(filename):
+    """Read the token data, returning the cached copy if neither the snapshot nor the log changed since the last read"""
+    state = _token_state(filename)
+    if _TOKEN_CACHE['filename'] == filename and _TOKEN_CACHE['state'] == state:
+        return _TOKEN_CACHE['data']
+
+    snapshot_state, log_state = state
+    data = read_json(filename) if snapshot_state else {}
+    if log_state:
+        with open(token_log_path(filename), 'rb') as f:
+            for line in f:
+                try:
+                    record = json_loads(line)
+                except ValueError:
+                    continue  # skip a partially written trailing line
+                data[record['open_id']] = record['payload']
+
+    _TOKEN_CACHE.update(filename=filename, state=state, data=data)
+    return data
+
+def write_tokens(data, filename):
+    """Write a full snapshot of the token data, clear the log it supersedes and refresh the cache"""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(json_dumps(data))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+    log_filename = token_log_path(filename)
+    if os.path.exists(log_filename):
+        os.remove(log_filename)
+
+    _TOKEN_CACHE.update(filename=filename, state=_token_state(filename), data=data)
+
+def append_tokens(updates, filename):
+    """Append per-user token updates ({open_id: payload}) to the log, compacting into the snapshot when the log gets large"""
+    # Build a new dict rather than updating the cached one, so callers iterating an earlier read are unaffected
+    data = {**read_tokens(filename), **updates}
+
+    with open(token_log_path(filename), 'a+b') as f:
+        # A torn write leaves the log without a trailing newline - start on a fresh line so only the torn record is lost
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        f.write(b''.join(json_dumps({'open_id': open_id, 'payload': payload}, indent=False) + b'\n'
+                         for open_id, payload in updates.items()))
+        f.flush()
+        os.fsync(f.fileno())
+
+    snapshot_state, log_state = _token_state(filename)
+    snapshot_size = snapshot_state[1] if snapshot_state else 0
+    if log_state[1] > TOKEN_LOG_COMPACT_RATIO * snapshot_size:
+        write_tokens(data, filename)
+    else:
+        _TOKEN_CACHE.update(filename=filename, state=(snapshot_state, log_state), data=data)
 
 def get_access_token_from_file(user, filename):
-    tokens = read_json(filename)
+    tokens = read_tokens(filename)
     data = tokens[user]
     return data['access_token']
 